@@ -27,36 +27,194 @@ __email__   = "sfromm gmail com"
 import hashlib
 import json
 import os
-import time
+import threading
 import uuid
+from collections import OrderedDict
 
-import requests
-from flask import Flask, jsonify, request
+# Flask, peewee and the blockchain are imported on first use so that
+# importing the package stays cheap.  Per-process state (database
+# connection, chain, cache) is created lazily after any fork, so each
+# worker gets its own.
+_lock = threading.Lock()
+_process = dict()
+_app = None
 
-import nocoin.blockchain
-from  nocoin.model import *
+def _state():
+    '''
+    Return the state for the current process, creating it on first use
 
-app = Flask(__name__)
+    :return: <dict>
+    '''
+    pid = os.getpid()
+    if _process.get('pid') != pid:
+        with _lock:
+            if _process.get('pid') != pid:
+                import nocoin.blockchain
+                _process.clear()
+                _process['blockchain'] = nocoin.blockchain.Blockchain()
+                _process['cache'] = ChainCache()
+                _process['node_identifier'] = os.environ.get(
+                    "NOCOIN_NODE_IDENTIFIER", str(uuid.uuid4()).replace('-', ''))
+                _process['pid'] = pid
+    return _process
 
-# Generate a globally unique address for the node
-node_identifier = str(uuid.uuid4()).replace('-', '')
+def get_blockchain():
+    ''' Return the blockchain for the current process '''
+    return _state()['blockchain']
 
-# Instantiate the blockchain
-blockchain = nocoin.blockchain.Blockchain()
+def get_cache():
+    ''' Return the chain cache for the current process '''
+    return _state()['cache']
+
+def get_node_identifier():
+    '''
+    Return the globally unique address for the node, taken from
+    NOCOIN_NODE_IDENTIFIER if set so that all workers share it.
+    '''
+    return _state()['node_identifier']
+
+class ChainCache(object):
+    '''
+    Cache of serialized chain data.
+
+    Blocks below the tip never change, so their serialized form is kept
+    per height in an LRU.  Whole responses are kept per endpoint and keyed
+    by the chain tip, so they are only rebuilt once a new block is added.
+
+    Full chain scans do not evict, so a chain longer than NOCOIN_CACHE_SIZE
+    keeps the heights already cached and serializes the rest each time.
+    Set the size above the chain length to avoid that.
+    '''
+
+    def __init__(self, size=None):
+        if size is None:
+            size = int(os.environ.get("NOCOIN_CACHE_SIZE", 1024))
+        self.size = size
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._responses = dict()
+
+    def block(self, row, evict=True):
+        '''
+        Serialize a block, reusing the cached copy for its height
+
+        :param row: <Block> model instance
+        :param evict: <bool> Evict the least recently used block if full,
+            otherwise leave the new block uncached
+        :return: <OrderedDict>
+        '''
+        ident = row.hash
+        with self._lock:
+            entry = self._blocks.get(row.height)
+            if entry and entry[0] == ident:
+                self._blocks.move_to_end(row.height)
+                return entry[1]
+
+        data = row.to_dict()
+        with self._lock:
+            if not evict and row.height not in self._blocks and len(self._blocks) >= self.size:
+                return data
+            self._blocks[row.height] = (ident, data)
+            self._blocks.move_to_end(row.height)
+            while len(self._blocks) > self.size:
+                self._blocks.popitem(last=False)
+        return data
+
+    def tip(self):
+        '''
+        Identify the current tip of the chain
+
+        :return: <tuple> of height and hash, or None if no blocks
+        '''
+        import nocoin.blockchain
+        from nocoin.model import Block
+
+        last = Block.last_block()
+        if not last:
+            return None
+        return (last.height, nocoin.blockchain.Blockchain.hash(self.block(last)))
+
+    def chain(self):
+        '''
+        Serialize all blocks, only loading transactions for uncached heights.
+        Scanning in height order through an LRU would evict each block
+        before it is needed again, so the scan does not evict.
+
+        :return: <list> of <OrderedDict>
+        '''
+        from nocoin.model import Block
+
+        return [ self.block(row, evict=False) for row in Block.chain() ]
+
+    def response(self, name, build):
+        '''
+        Return the serialized response for an endpoint at the current tip
+
+        :param name: <str> Name of the endpoint
+        :param build: Callable returning the response data
+        :return: <tuple> of body <bytes> and strong ETag <str>
+        '''
+        tip = self.tip()
+        with self._lock:
+            cached = self._responses.get(name)
+            if cached and cached[0] == tip:
+                return cached[1], cached[2]
+
+        body = json.dumps(build(), sort_keys=True).encode()
+        etag = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            self._responses[name] = (tip, body, etag)
+        return body, etag
+
+    def clear(self):
+        ''' Drop all cached blocks and responses '''
+        with self._lock:
+            self._blocks.clear()
+            self._responses.clear()
+
+def cached_response(name, build):
+    '''
+    Build a JSON response carrying a strong ETag, answering a matching
+    If-None-Match with 304 Not Modified.
+
+    :param name: <str> Name of the endpoint
+    :param build: Callable returning the response data
+    '''
+    from flask import Response, request
+
+    body, etag = get_cache().response(name, build)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
-@app.route('/mine', methods=['GET'])
 def mine():
+    from flask import jsonify
+    from peewee import IntegrityError
+
+    blockchain = get_blockchain()
     last_block = blockchain.last_block()
     proof = blockchain.proof_of_work(last_block)
 
+    # another worker sharing the database may have mined in the meantime
+    conflict = { 'message' : "Chain changed while mining, try again" }
+    if blockchain.last_block() != last_block:
+        return jsonify(conflict), 409
+
     blockchain.new_transaction(
         sender="0",
-        recipient=node_identifier,
+        recipient=get_node_identifier(),
         amount=1
     )
 
     last_hash = blockchain.hash(last_block)
-    new_block = blockchain.new_block(proof, last_hash)
+    try:
+        new_block = blockchain.new_block(proof, last_hash)
+    except IntegrityError:
+        blockchain.current_transactions = list()
+        return jsonify(conflict), 409
 
     response = {
         'message'       : "New block forged",
@@ -67,15 +225,39 @@ def mine():
     }
     return jsonify(response), 200
 
-@app.route('/chain', methods=['GET'])
 def full_chain():
-    response = {
-        'chain'  : blockchain.chain(),
-        'length' : len(blockchain.chain()),
-    }
-    return jsonify(response), 200
+    def build():
+        chain = get_cache().chain()
+        return {
+            'chain'  : chain,
+            'length' : len(chain),
+        }
+    return cached_response('chain', build)
 
-@app.route('/', methods=['GET'])
 def hello():
-    return jsonify({ "message": "hello", "chain": blockchain.chain }), 200
+    return cached_response('hello', lambda: { "message": "hello", "chain": get_cache().chain() })
+
+def create_app():
+    '''
+    Application factory.  The database and chain are not touched here;
+    they are created per process on the first request.
+
+    :return: <Flask>
+    '''
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.add_url_rule('/mine', 'mine', mine, methods=['GET'])
+    app.add_url_rule('/chain', 'full_chain', full_chain, methods=['GET'])
+    app.add_url_rule('/', 'hello', hello, methods=['GET'])
+    return app
+
+def __getattr__(name):
+    ''' Create nocoin.app on first access for existing callers '''
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
@@ -24,6 +24,7 @@ import json
 import logging
 import sqlite3
 import datetime
+import time
 import uuid
 from urllib.parse import urlparse
 from nocoin.model import *
@@ -41,7 +42,14 @@ class Blockchain(object):
         self.db.create_tables()
 
         if not self.last_block():
-            self.new_block(100, '1')
+            try:
+                self.new_block(100, '1')
+            except IntegrityError:
+                # only tolerate another process sharing the database
+                # having created it first
+                if not self.last_block():
+                    raise
+                logging.info("genesis block already exists")
 
     def last_block(self):
         '''
@@ -149,13 +157,27 @@ class Blockchain(object):
         if not previous_hash:
             previous_hash = self.hash(self.last_block())
 
-        models = list()
-        block = Block(height=height, proof=proof, previous_hash=previous_hash, last_height=last_height)
-        self.db.save(block)
+        # hash the block as serialized by Block.to_dict(), less its own hash
+        timestamp = time.time()
+        block_hash = self.hash( {
+            'height'        : height,
+            'proof'         : proof,
+            'previous_hash' : previous_hash,
+            'last_block'    : last_height,
+            'timestamp'     : timestamp,
+            'transactions'  : self.current_transactions,
+        } )
+
+        # save the block and its transactions together so that readers
+        # never see a block without its transactions
+        with self.db.database.atomic():
+            block = Block(height=height, proof=proof, previous_hash=previous_hash, last_height=last_height,
+                          timestamp=timestamp, hash=block_hash)
+            self.db.save(block)
 
-        for txn in self.current_transactions:
-            t = Transaction(sender=txn['sender'], recipient=txn['recipient'], amount=txn['amount'], block=block)
-            self.db.save(t)
+            for txn in self.current_transactions:
+                t = Transaction(sender=txn['sender'], recipient=txn['recipient'], amount=txn['amount'], block=block)
+                self.db.save(t)
 
         # reset the current list of transactions
         self.current_transactions = list()
@@ -228,6 +250,8 @@ class Blockchain(object):
 
         :return: True if our chain was replaced, False if not.
         '''
+        import requests
+
         new_chain = None
         max_length = len(self.chain())
 
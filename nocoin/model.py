@@ -91,7 +91,7 @@ class Block(BaseModel):
             'proof'         : self.proof,
             'hash'          : self.hash,
             'previous_hash' : self.previous_hash,
-            'last_block'    : self.last_block().id,
+            'last_block'    : self.last_height,
             'timestamp'     : self.timestamp,
             'transactions'  : list(),
         }
@@ -45,4 +45,5 @@ if __name__ == '__main__':
     args = parser.parse_args()
     setup_logging(args)
 
-    nocoin.app.run(host='0.0.0.0', port=args.port)
+    app = nocoin.create_app()
+    app.run(host='0.0.0.0', port=args.port)
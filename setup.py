@@ -18,6 +18,7 @@ setup(
     author_email=__email__,
     packages=find_packages(),
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=[
         'Flask',
         'requests',
@@ -2,6 +2,9 @@ import hashlib
 import json
 import logging
 import os
+import subprocess
+import sys
+from unittest import mock
 from urllib.parse import urlparse
 
 os.environ["NOCOIN_DATABASE_ENGINE"] = "sqlite"
@@ -92,6 +95,29 @@ class TestBlockChain(BlockChainTestCase):
 
         assert new_block == self.blockchain.last_block()
 
+    def test_last_block_is_previous_height(self):
+        genesis = self.blockchain.last_block()
+        self.create_block()
+        last_block = self.blockchain.last_block()
+
+        assert genesis['last_block'] is None
+        assert last_block['last_block'] == last_block['height'] - 1
+        assert self.blockchain.chain()[0] == genesis
+
+    def test_genesis_lost_race(self):
+        def lost_race(blockchain, proof, previous_hash):
+            Block.create(height=0, proof=proof, previous_hash=previous_hash, hash='abc')
+            raise IntegrityError("UNIQUE constraint failed: block.height")
+
+        with mock.patch.object(Blockchain, 'new_block', autospec=True, side_effect=lost_race):
+            blockchain = Blockchain()
+
+        assert blockchain.last_block()['height'] == 0
+
+    def test_genesis_failure_is_raised(self):
+        with mock.patch.object(Blockchain, 'new_block', side_effect=IntegrityError("NOT NULL")):
+            self.assertRaises(IntegrityError, Blockchain)
+
 class TestBlockChainNodes(BlockChainTestCase):
 
     def test_a_register_node(self):
@@ -118,3 +144,176 @@ class TestBlockChainNodes(BlockChainTestCase):
         node = { 'node' : urlparse(uri).netloc }
 
         assert len(nodes) == 1
+
+class TestChainCache(BlockChainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = ChainCache(size=2)
+
+    def test_cached_chain_matches(self):
+        self.create_block()
+
+        assert self.cache.chain() == self.blockchain.chain()
+
+    def test_tip_changes_with_new_block(self):
+        tip = self.cache.tip()
+        self.create_block()
+
+        assert self.cache.tip() != tip
+        assert self.cache.tip()[0] == self.blockchain.last_block()['height']
+
+    def test_response_reused_until_new_block(self):
+        build = lambda: { 'chain' : self.cache.chain() }
+        body, etag = self.cache.response('chain', build)
+
+        assert self.cache.response('chain', lambda: None) == (body, etag)
+
+        self.create_block()
+        new_body, new_etag = self.cache.response('chain', build)
+
+        assert new_etag != etag
+        assert json.loads(new_body.decode())['chain'] == self.blockchain.chain()
+
+    def test_block_cache_reuse(self):
+        assert self.cache.chain()[0] is self.cache.chain()[0]
+
+    def test_chain_longer_than_cache(self):
+        self.create_block()
+        self.create_block(proof=456, previous_hash='def')
+        first = self.cache.chain()
+        second = self.cache.chain()
+
+        # three blocks through a cache of two keeps the first two
+        assert first[0] is second[0]
+        assert first[1] is second[1]
+        assert first[2] is not second[2]
+        assert first == second
+
+    def test_block_cache_eviction(self):
+        self.create_block()
+        self.cache.chain()
+        self.create_block(proof=456, previous_hash='def')
+        self.cache.tip()
+
+        # the new tip evicts the least recently used block
+        assert self.cache.chain()[0] is not self.cache.chain()[0]
+
+class TestCachedResponses(BlockChainTestCase):
+
+    def setUp(self):
+        # create the per-process state first so that the blockchain made
+        # in setUp is the database the views see
+        get_cache().clear()
+        super().setUp()
+        self.client = create_app().test_client()
+
+    def get(self, path, etag=None):
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client.get(path, headers=headers)
+
+    def test_strong_etag(self):
+        for path in ('/', '/chain'):
+            response = self.get(path)
+
+            assert response.status_code == 200
+            assert response.headers['ETag'].startswith('"')
+            assert not response.headers['ETag'].startswith('W/')
+
+    def test_chain_body(self):
+        response = self.get('/chain')
+        data = json.loads(response.get_data(as_text=True))
+
+        assert data['chain'] == json.loads(json.dumps(self.blockchain.chain()))
+        assert data['length'] == len(self.blockchain.chain())
+
+    def test_if_none_match(self):
+        for path in ('/', '/chain'):
+            etag = self.get(path).headers['ETag']
+
+            for match in (etag, '*'):
+                response = self.get(path, match)
+
+                assert response.status_code == 304
+                assert response.get_data() == b''
+                assert response.headers['ETag'] == etag
+
+            assert self.get(path, '"stale"').status_code == 200
+
+    def test_new_etag_after_new_block(self):
+        for path in ('/', '/chain'):
+            etag = self.get(path).headers['ETag']
+            self.create_block(proof=len(self.blockchain.chain()), previous_hash=path)
+            response = self.get(path, etag)
+
+            assert response.status_code == 200
+            assert response.headers['ETag'] != etag
+
+class TestMine(BlockChainTestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        super().setUp()
+        self.client = create_app().test_client()
+
+    def test_mine(self):
+        with mock.patch.object(Blockchain, 'proof_of_work', return_value=123):
+            response = self.client.get('/mine')
+
+        assert response.status_code == 200
+        assert self.blockchain.last_block()['height'] == 1
+
+    def test_chain_changed_while_mining(self):
+        def other_worker(last_block):
+            self.create_block()
+            return 123
+
+        with mock.patch.object(Blockchain, 'proof_of_work', side_effect=other_worker):
+            response = self.client.get('/mine')
+
+        assert response.status_code == 409
+        assert len(self.blockchain.chain()) == 2
+
+    def test_lost_race_for_height(self):
+        with mock.patch.object(Blockchain, 'proof_of_work', return_value=123), \
+                mock.patch.object(Blockchain, 'new_block', side_effect=IntegrityError("UNIQUE")):
+            response = self.client.get('/mine')
+
+        assert response.status_code == 409
+        assert get_blockchain().current_transactions == []
+
+class TestAppFactory(TestCase):
+
+    def test_create_app(self):
+        app = create_app()
+
+        assert app is not create_app()
+        assert set(r.rule for r in app.url_map.iter_rules()) >= { '/', '/chain', '/mine' }
+
+    def test_process_state_is_reused(self):
+        assert get_blockchain() is get_blockchain()
+        assert get_cache() is get_cache()
+        assert get_node_identifier() == get_node_identifier()
+
+    def test_state_rebuilt_after_fork(self):
+        blockchain = get_blockchain()
+        cache = get_cache()
+
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            assert get_blockchain() is not blockchain
+            assert get_cache() is not cache
+            assert get_blockchain() is get_blockchain()
+
+    def test_node_identifier_from_environment(self):
+        with mock.patch.dict(os.environ, { 'NOCOIN_NODE_IDENTIFIER' : 'abc' }), \
+                mock.patch('os.getpid', return_value=os.getpid() + 1):
+            assert get_node_identifier() == 'abc'
+
+    def test_import_is_lazy(self):
+        code = "import sys, nocoin; print(' '.join(m for m in ('flask', 'peewee', 'requests') if m in sys.modules))"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+
+        assert output.decode().strip() == ''